@@ -0,0 +1,201 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import fcntl
+import hashlib
+import importlib
+import os
+import sqlite3
+import time
+from bisect import bisect_left
+
+from mo_json import value2json, json2value
+from mo_logs import Log
+from mo_threads import Lock
+
+VIRTUAL_NODES = 64  # POINTS PER MEMBER ON THE HASH RING
+DEFAULT_LEASES = "coco.leases.SqliteLeases"
+
+
+class HashRing(object):
+    """
+    CONSISTENT HASHING: A MEMBER JOINING OR LEAVING ONLY MOVES THE KEYS
+    ADJACENT TO ITS OWN POINTS ON THE RING
+    """
+
+    def __init__(self, members, virtual_nodes=VIRTUAL_NODES):
+        self.members = sorted(members)
+        points = sorted(
+            (hash_key(m + "|" + str(i)), m)
+            for m in self.members
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [h for h, _ in points]
+        self.owners = [m for _, m in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        i = bisect_left(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[i]
+
+
+def hash_key(value):
+    """
+    :return: STABLE (ACROSS PROCESSES AND MACHINES) 64-BIT HASH OF value
+    """
+    return int(hashlib.md5(value.encode("utf8")).hexdigest()[:16], 16)
+
+
+def new_leases(settings):
+    """
+    :param settings: {"class": "module.ClassName", ...} THE REST ARE PASSED TO THE CONSTRUCTOR
+    """
+    class_name = settings["class"] or DEFAULT_LEASES
+    path, name = class_name.rsplit(".", 1)
+    try:
+        constructor = getattr(importlib.import_module(path), name)
+    except Exception as e:
+        Log.error("Can not find leases class {{class|quote}}", {"class": class_name}, cause=e)
+    kwargs = {k: v for k, v in settings.items() if k != "class"}
+    return constructor(**kwargs)
+
+
+class Leases(object):
+    """
+    SHARED STORE OF EXPIRING LEASES; SUBCLASS FOR OTHER BACKENDS
+    """
+
+    def acquire(self, key, owner, duration):
+        """
+        TAKE, OR RENEW, THE LEASE ON key
+        :return: True IF owner NOW HOLDS THE LEASE FOR duration SECONDS
+        """
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        """
+        GIVE UP THE LEASE, IF owner STILL HOLDS IT
+        """
+        raise NotImplementedError
+
+    def live(self, prefix):
+        """
+        :return: KEYS, STARTING WITH prefix, WITH AN UNEXPIRED LEASE
+        """
+        raise NotImplementedError
+
+
+class SqliteLeases(Leases):
+    """
+    LEASES IN A SQLITE FILE, SHARED BY THE PROCESSES ON ONE MACHINE
+    """
+
+    def __init__(self, filename):
+        self.locker = Lock("sqlite leases")
+        self.db = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.locker:
+            self.db.execute("CREATE TABLE IF NOT EXISTS lease (key TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def acquire(self, key, owner, duration):
+        now = time.time()
+        with self.locker:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT owner, expires FROM lease WHERE key=?", (key,)).fetchone()
+                if row and row[0] != owner and row[1] > now:
+                    self.db.execute("COMMIT")
+                    return False
+                self.db.execute("INSERT OR REPLACE INTO lease (key, owner, expires) VALUES (?, ?, ?)", (key, owner, now + duration))
+                self.db.execute("COMMIT")
+                return True
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def release(self, key, owner):
+        with self.locker:
+            self.db.execute("DELETE FROM lease WHERE key=? AND owner=?", (key, owner))
+
+    def live(self, prefix):
+        with self.locker:
+            rows = self.db.execute("SELECT key FROM lease WHERE substr(key, 1, ?)=? AND expires>?", (len(prefix), prefix, time.time())).fetchall()
+        return [r[0] for r in rows]
+
+
+class FileLeases(Leases):
+    """
+    ONE JSON FILE PER LEASE IN A SHARED DIRECTORY, GUARDED BY flock() ON A MUTEX FILE
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.mutex = os.path.join(directory, "mutex")
+
+    def _filename(self, key):
+        return os.path.join(self.directory, hashlib.md5(key.encode("utf8")).hexdigest() + ".json")
+
+    def _lock(self):
+        # THE KERNEL DROPS THE LOCK WHEN THE HOLDER DIES, SO NO STALE MUTEX
+        f = open(self.mutex, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _unlock(self, f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def _read(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                return json2value(f.read().decode("utf8"))
+        except (IOError, OSError):
+            return None
+
+    def acquire(self, key, owner, duration):
+        now = time.time()
+        filename = self._filename(key)
+        mutex = self._lock()
+        try:
+            lease = self._read(filename)
+            if lease and lease.owner != owner and lease.expires > now:
+                return False
+            temp = filename + ".tmp"
+            with open(temp, "wb") as f:
+                f.write(value2json({"key": key, "owner": owner, "expires": now + duration}).encode("utf8"))
+            os.rename(temp, filename)  # SO live() NEVER READS A PARTIAL FILE
+            return True
+        finally:
+            self._unlock(mutex)
+
+    def release(self, key, owner):
+        filename = self._filename(key)
+        mutex = self._lock()
+        try:
+            lease = self._read(filename)
+            if lease and lease.owner == owner:
+                os.remove(filename)
+        finally:
+            self._unlock(mutex)
+
+    def live(self, prefix):
+        now = time.time()
+        output = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            lease = self._read(os.path.join(self.directory, name))
+            if lease and lease.key.startswith(prefix) and lease.expires > now:
+                output.append(lease.key)
+        return output
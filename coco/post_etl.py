@@ -10,27 +10,39 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import hashlib
+import os
+import tempfile
+
 from future.utils import text_type
 from jx_python import jx
-from mo_dots import coalesce, wrap
+from mo_dots import coalesce, wrap, listwrap
+from mo_json import value2json, json2value
 from mo_logs import Log
 from mo_logs import constants
 from mo_logs import startup
 from mo_math import UNION
-from mo_threads import Thread, Signal, Queue, THREAD_STOP
+from mo_threads import Thread, Signal, Queue, THREAD_STOP, Till
 
 from mo_times.dates import Date, unicode2Date
+from mo_times.durations import Duration
 from mo_times.timer import Timer
 from pyLibrary.env import http, elasticsearch
 
+from coco.shard import Shard
+
 DEBUG = False
 NUM_THREAD = 4
+SETTLE = "day"  # HOW LONG AFTER A PUSH ITS COVERAGE MAY STILL ARRIVE
+POLL_INTERVAL = "5minute"
+START = "today-week"  # WHERE THE DAEMON STARTS WHEN THERE IS NO WATERMARK
 
 
-def process_batch(todo_queue, revision, coverage_index, coverage_summary_index, settings, please_stop):
+def process_batch(todo_queue, revision, previous_revision, coverage_index, coverage_summary_index, settings, please_stop):
     """
     :param todo: list of files to process as a single block 
-    :param coverage_index: 
+    :param previous_revision: revision12 whose summaries may be reused for unchanged files (or None)
+    :param coverage_index: (None in daemon mode)
     :param coverage_summary_index: 
     :param settings: 
     :param please_stop: 
@@ -80,6 +92,22 @@ def process_batch(todo_queue, revision, coverage_index, coverage_summary_index,
             "format": "list"
         }).data
 
+        # REUSE SUMMARIES OF FILES UNCHANGED SINCE THE PREVIOUS REVISION
+        if previous_revision:
+            reused = _reuse_summaries(refresh_required, revision, previous_revision, coverage_example[0], settings)
+            if reused:
+                Log.note(
+                    "Reuse {{num}} summaries from revision {{previous}} for revision {{revision}}",
+                    num=len(reused),
+                    previous=previous_revision,
+                    revision=revision
+                )
+                coverage_summary_index.extend(reused)
+                reused_files = set(r["value"]["source"]["file"]["name"] for r in reused)
+                refresh_required = [f for f in refresh_required if f not in reused_files]
+                if not refresh_required:
+                    continue
+
         with Timer("pull coverage records"):
             coverage_records = http.post_json(settings.url, json={
                 "from": "coverage",
@@ -117,7 +145,8 @@ def process_batch(todo_queue, revision, coverage_index, coverage_summary_index,
                 "repo": coverage_example[0].repo,
                 "etl": {
                     "timestamp": Date.now(),
-                    "num_source_records": len(file_level_coverage_records)  # RECORD NUMBER OF RECORDS USED TO COMPOSE THIS; IF THERE ARE MORE IN THE FUTURE, RECALC
+                    "num_source_records": len(file_level_coverage_records),  # RECORD NUMBER OF RECORDS USED TO COMPOSE THIS; IF THERE ARE MORE IN THE FUTURE, RECALC
+                    "fingerprint": _fingerprint(len(file_level_coverage_records), cov, uncov)
                 }
             }
             coverage_summaries.append({
@@ -128,6 +157,106 @@ def process_batch(todo_queue, revision, coverage_index, coverage_summary_index,
         coverage_summary_index.extend(coverage_summaries)
 
 
+def _reuse_summaries(file_names, revision, previous_revision, example, settings):
+    """
+    COPY THE previous_revision SUMMARY OF ANY FILE WHOSE COVERAGE RECORDS
+    HAVE THE SAME FINGERPRINT IN BOTH REVISIONS
+    :param file_names: files that require a summary for revision
+    :param example: a coverage record of revision, for the build and repo properties
+    :return: list of {"id", "value"} to add to the summary index
+    """
+    previous_fingerprints = http.post_json(settings.url, json={
+        "from": "coverage-summary",
+        "select": [
+            {"name": "name", "value": "source.file.name"},
+            {"name": "fingerprint", "value": "etl.fingerprint"}
+        ],
+        "where": {"and": [
+            {"eq": {"build.revision12": previous_revision}},
+            {"in": {"source.file.name": file_names}},
+            {"exists": "etl.fingerprint"}
+        ]},
+        "limit": 100000,
+        "format": "list"
+    }).data
+    if not previous_fingerprints:
+        return []
+    previous_fingerprints = {r.name: r.fingerprint for r in previous_fingerprints}
+
+    # ONE ROW PER FILE, NOT ONE PER RECORD
+    with Timer("pull coverage fingerprints"):
+        fingerprint_records = http.post_json(settings.url, json={
+            "from": "coverage",
+            "select": [
+                {"name": "count", "aggregate": "count"},
+                {"name": "covered", "value": "source.file.covered", "aggregate": "union"},
+                {"name": "uncovered", "value": "source.file.uncovered", "aggregate": "union"}
+            ],
+            "edges": ["source.file.name"],
+            "where": {"and": [
+                {"missing": "source.method.name"},
+                {"neq": {"source.file.total_covered": 0}},
+                {"eq": {"build.revision12": revision}},
+                {"in": {"source.file.name": list(previous_fingerprints.keys())}}
+            ]},
+            "limit": 100000,
+            "format": "list"
+        }).data
+    unchanged = {
+        r.source.file.name: r.count
+        for r in fingerprint_records
+        if r.source.file.name and previous_fingerprints.get(r.source.file.name) == _fingerprint(r.count, listwrap(r.covered), listwrap(r.uncovered))
+    }
+    if not unchanged:
+        return []
+
+    # ONLY THE UNCHANGED FILES ARE FETCHED, FROM THE SUMMARY, NOT THE RAW RECORDS
+    previous_summaries = http.post_json(settings.url, json={
+        "from": "coverage-summary",
+        "select": "source",
+        "where": {"and": [
+            {"eq": {"build.revision12": previous_revision}},
+            {"in": {"source.file.name": list(unchanged.keys())}}
+        ]},
+        "limit": 100000,
+        "format": "list"
+    }).data
+
+    output = []
+    for previous in previous_summaries:
+        source_file_name = previous.file.name
+        coverage = {
+            "source": previous,
+            "build": example.build,
+            "repo": example.repo,
+            "etl": {
+                "timestamp": Date.now(),
+                "num_source_records": unchanged[source_file_name],
+                "fingerprint": previous_fingerprints[source_file_name],
+                "reused_from": previous_revision
+            }
+        }
+        output.append({
+            "id": "|".join([revision, source_file_name]),
+            "value": coverage
+        })
+    return output
+
+
+def _fingerprint(count, covered, uncovered):
+    """
+    :param count: number of coverage records for the file
+    :param covered: lines covered by any record
+    :param uncovered: lines not covered by some record
+    :return: RECORD COUNT, AND HASH OF THE (covered, uncovered) LINE SETS THEY AGGREGATE TO
+    """
+    # THE SCHEMA MAPS LINES AS STRINGS, SO ES AGGREGATES RETURN "12" WHERE THE RECORDS HAVE 12
+    cov = set(int(c) for c in covered)
+    uncov = set(int(u) for u in uncovered) - cov
+    lines = hashlib.md5(value2json([sorted(cov), sorted(uncov)]).encode("utf8")).hexdigest()
+    return text_type(int(count)) + "|" + lines
+
+
 def loop(source, coverage_summary_index, settings, please_stop):
     Log.note("Started loop")
     try:
@@ -150,7 +279,7 @@ def loop(source, coverage_summary_index, settings, please_stop):
             with Timer("Pulling work from index {{index}}", param={"index": index_name}):
                 revisions = http.post_json(settings.url, json={
                     "from": "coverage",
-                    "groupby": ["build.revision12", "repo.push.date"],
+                    "groupby": ["build.revision12", "repo.push.date", "repo.branch.name"],
                     "where": {"and": [
                         {"gte": {"repo.push.date": push_date_filter}}
                     ]},
@@ -159,44 +288,13 @@ def loop(source, coverage_summary_index, settings, please_stop):
                     "limit": 10000
                 }).data
 
-                for rev in revisions.build.revision12:
-                    todo = http.post_json(settings.url, json={
-                        "from": "coverage",
-                        "groupby": ["source.file.name"],
-                        "where": {"and": [
-                            {"eq": {"build.revision12": rev}},
-                            {"neq": {"source.file.total_covered": 0}},
-                            {"missing": "source.method.name"}
-                        ]},
-                        "format": "list",
-                        "limit": 100000
-                    })
-
-                    queue = Queue("pending source files to review")
-                    queue.extend(_groupby_size(todo.data, size=10000))
-
-                    num_threads = coalesce(settings.threads, NUM_THREAD)
-                    Log.note("Launch {{num}} threads", num=num_threads)
-                    threads = [
-                        Thread.run(
-                            "processor" + text_type(i),
-                            process_batch,
-                            queue,
-                            rev,
-                            coverage_index,
-                            coverage_summary_index,
-                            settings,
-                            please_stop=please_stop
-                        )
-                        for i in range(num_threads)
-                    ]
-
-                    # ADD STOP MESSAGE
-                    queue.add(THREAD_STOP)
-
-                    # WAIT FOR THEM TO COMPLETE
-                    for t in threads:
-                        t.join()
+                previous_revs = {}  # MAP FROM BRANCH TO ITS LATEST REVISION
+                for r in revisions:
+                    if please_stop:
+                        return
+                    rev = r.build.revision12
+                    process_revision(rev, previous_revs.get(r.repo.branch.name), coverage_index, coverage_summary_index, None, settings, please_stop)
+                    previous_revs[r.repo.branch.name] = rev
         return
 
     except Exception as e:
@@ -206,6 +304,184 @@ def loop(source, coverage_summary_index, settings, please_stop):
         please_stop.go()
 
 
+def daemon(coverage_summary_index, shard, settings, please_stop):
+    """
+    POLL FOR REVISIONS PUSHED AFTER THE PERSISTED HIGH-WATER MARK, FOREVER
+    REVISIONS WITHIN THE settle WINDOW BEFORE THE MARK ARE CHECKED AGAIN, TO
+    PICK UP COVERAGE THAT ARRIVES LATE; ONLY THOSE WITH MORE COVERAGE RECORDS
+    THAN THEIR SUMMARIES ACCOUNT FOR ARE PROCESSED
+    :param settings: settings.daemon = {"watermark": filename, "settle": duration, "interval": duration, "start": date}
+    """
+    Log.note("Started daemon")
+    try:
+        filename = settings.daemon.watermark
+        settle = Duration(coalesce(settings.daemon.settle, SETTLE))
+        interval = Duration(coalesce(settings.daemon.interval, POLL_INTERVAL))
+        try:
+            watermark = _read_watermark(filename)
+        except Exception as e:
+            Log.warning("Can not read watermark {{filename|quote}}, starting from {{start}}", filename=filename, start=coalesce(settings.daemon.start, START), cause=e)
+            watermark = None
+        if watermark:
+            Log.note("Resume from revision {{revision}} pushed {{date|datetime}}", revision=watermark.revision, date=watermark.date)
+
+        while not please_stop:
+            try:
+                since = _since(watermark, settle, settings.daemon.start)
+                watermark = _poll(since, watermark, filename, coverage_summary_index, shard, settings, please_stop)
+            except Exception as e:
+                Log.warning("Problem processing, will retry", cause=e)
+
+            (please_stop | Till(seconds=interval.seconds)).wait()
+    except Exception as e:
+        Log.warning("Daemon failed", cause=e)
+    finally:
+        Log.note("Daemon is done")
+        please_stop.go()
+
+
+def _since(watermark, settle, start):
+    """
+    :return: EARLIEST PUSH DATE TO LOOK AT
+    """
+    if watermark:
+        return Date(watermark.date) - settle
+    return Date(coalesce(start, START))
+
+
+def _poll(since, watermark, filename, coverage_summary_index, shard, settings, please_stop):
+    """
+    PROCESS THE REVISIONS PUSHED SINCE since THAT ARE NOT FULLY SUMMARIZED
+    :return: THE NEW WATERMARK
+    """
+    with Timer("Pulling revisions pushed since {{since|datetime}}", param={"since": since}):
+        revisions = http.post_json(settings.url, json={
+            "from": "coverage",
+            "select": [{"name": "count", "aggregate": "count"}],
+            "groupby": ["build.revision12", "repo.push.date", "repo.branch.name"],
+            "where": {"and": [
+                {"gte": {"repo.push.date": since}},
+                {"exists": "source.file.name"},
+                {"neq": {"source.file.total_covered": 0}},
+                {"missing": "source.method.name"}
+            ]},
+            "format": "list",
+            "sort": "repo.push.date",
+            "limit": 10000
+        }).data
+
+        # HOW MANY OF THOSE RECORDS ARE ALREADY IN A SUMMARY?
+        summarized = http.post_json(settings.url, json={
+            "from": "coverage-summary",
+            "select": [{"name": "count", "value": "etl.num_source_records", "aggregate": "sum"}],
+            "edges": ["build.revision12"],
+            "where": {"and": [
+                {"gte": {"repo.push.date": since}},
+                {"exists": "source.file.name"}
+            ]},
+            "format": "list",
+            "limit": 10000
+        }).data
+        summarized = {s.build.revision12: int(coalesce(s.count, 0)) for s in summarized}
+
+    previous_revs = {}  # MAP FROM BRANCH TO ITS LATEST REVISION
+    for r in revisions:
+        if please_stop:
+            break
+        rev = r.build.revision12
+        if summarized.get(rev, 0) != int(r.count):
+            process_revision(rev, previous_revs.get(r.repo.branch.name), None, coverage_summary_index, shard, settings, please_stop)
+            if please_stop:
+                # INTERRUPTED, SO THE REVISION IS NOT DONE
+                break
+        previous_revs[r.repo.branch.name] = rev
+
+        mark = wrap({"date": r.repo.push.date, "revision": rev})
+        if not watermark or (mark.date, mark.revision) > (watermark.date, watermark.revision):
+            watermark = mark
+            _write_watermark(filename, watermark)
+    return watermark
+
+
+def process_revision(rev, previous_rev, coverage_index, coverage_summary_index, shard, settings, please_stop):
+    """
+    SUMMARIZE ALL FILES OF ONE REVISION, USING settings.threads THREADS
+    :param shard: Shard that decides which files this worker summarizes (or None for all)
+    """
+    todo = http.post_json(settings.url, json={
+        "from": "coverage",
+        "groupby": ["source.file.name"],
+        "where": {"and": [
+            {"eq": {"build.revision12": rev}},
+            {"neq": {"source.file.total_covered": 0}},
+            {"missing": "source.method.name"}
+        ]},
+        "format": "list",
+        "limit": 100000
+    })
+
+    try:
+        todo_data = todo.data
+        if shard:
+            # SHARD BY FILE, BEFORE BATCHING, SO ALL WORKERS AGREE ON THE KEYS
+            work = {}
+            for t in todo_data:
+                if not t.source.file.name:
+                    continue
+                work.setdefault(shard.key(rev, t.source.file.name), []).append(t)
+            claimed = [k for k in sorted(work.keys()) if shard.claim(k)]
+            todo_data = [t for k in claimed for t in work[k]]
+            Log.note("Shard claimed {{num}} of {{total}} buckets for revision {{revision}}", num=len(claimed), total=len(work), revision=rev)
+
+        queue = Queue("pending source files to review")
+        queue.extend(_groupby_size(todo_data, size=10000))
+
+        num_threads = coalesce(settings.threads, NUM_THREAD)
+        Log.note("Launch {{num}} threads", num=num_threads)
+        threads = [
+            Thread.run(
+                "processor" + text_type(i),
+                process_batch,
+                queue,
+                rev,
+                previous_rev,
+                coverage_index,
+                coverage_summary_index,
+                settings,
+                please_stop=please_stop
+            )
+            for i in range(num_threads)
+        ]
+
+        # ADD STOP MESSAGE
+        queue.add(THREAD_STOP)
+
+        # WAIT FOR THEM TO COMPLETE
+        for t in threads:
+            t.join()
+    finally:
+        if shard:
+            shard.release_revision(rev)
+
+
+def _read_watermark(filename):
+    """
+    :return: {"date", "revision"} OF THE LATEST REVISION PROCESSED, OR None
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        return json2value(f.read().decode("utf8"))
+
+
+def _write_watermark(filename, watermark):
+    # UNIQUE TEMP FILE, BECAUSE SHARDED WORKERS MAY SHARE THE WATERMARK
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    with os.fdopen(handle, "wb") as f:
+        f.write(value2json(watermark).encode("utf8"))
+    os.rename(temp, filename)  # NEVER LEAVE A PARTIAL FILE
+
+
 def _groupby_size(items, size):
     acc = 0
     output = []
@@ -220,26 +496,52 @@ def _groupby_size(items, size):
         yield wrap(output)
 
 
+def run(config):
+    constants.set(config.constants)
+    Log.start(config.debug)
+    if config.shard and not config.daemon:
+        # ONLY THE DAEMON RETURNS TO THE WORK OF A WORKER THAT DIED
+        Log.error("Sharded mode requires daemon mode")
+    if config.daemon and not config.daemon.watermark:
+        Log.error("Expecting daemon.watermark setting, the file to persist progress")
+
+    please_stop = Signal("main stop signal")
+    shard = None
+    if config.shard:
+        # MANY WORKERS SPLIT THE WORK, SO NO SingleInstance
+        shard = Shard(config.shard, please_stop)
+    coverage_summary_index = elasticsearch.Cluster(config.destination).get_or_create_index(read_only=False, kwargs=config.destination)
+    coverage_summary_index.add_alias(config.destination.index)
+    Log.note("start processing")
+    if config.daemon:
+        Thread.run(
+            "processing daemon",
+            daemon,
+            coverage_summary_index,
+            shard,
+            config,
+            please_stop=please_stop
+        )
+    else:
+        Thread.run(
+            "processing loop",
+            loop,
+            config.source,
+            coverage_summary_index,
+            config,
+            please_stop=please_stop
+        )
+    Thread.wait_for_shutdown_signal(please_stop)
+
+
 def main():
     try:
         config = startup.read_settings()
-        with startup.SingleInstance(flavor_id=config.args.filename):
-            constants.set(config.constants)
-            Log.start(config.debug)
-
-            please_stop = Signal("main stop signal")
-            coverage_summary_index = elasticsearch.Cluster(config.destination).get_or_create_index(read_only=False, kwargs=config.destination)
-            coverage_summary_index.add_alias(config.destination.index)
-            Log.note("start processing")
-            Thread.run(
-                "processing loop",
-                loop,
-                config.source,
-                coverage_summary_index,
-                config,
-                please_stop=please_stop
-            )
-            Thread.wait_for_shutdown_signal(please_stop)
+        if config.shard:
+            run(config)
+        else:
+            with startup.SingleInstance(flavor_id=config.args.filename):
+                run(config)
     except Exception, e:
         Log.error("Problem with code coverage score calculation", cause=e)
     finally:
@@ -0,0 +1,144 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import socket
+import time
+
+from future.utils import text_type
+from mo_dots import coalesce
+from mo_logs import Log
+from mo_threads import Thread, Lock, Till
+
+from coco.leases import HashRing, hash_key, new_leases
+
+DEBUG = False
+MEMBER_PREFIX = "member|"
+WORK_PREFIX = "work|"
+LEASE_DURATION = 600  # SECONDS A LEASE IS VALID WITHOUT RENEWAL
+HEARTBEAT = 30  # SECONDS BETWEEN RENEWALS
+BUCKETS = 64  # UNITS OF WORK PER REVISION
+
+
+class Shard(object):
+    """
+    ONE WORKER AMONG MANY: MEMBERSHIP IS A LEASE RENEWED BY A HEARTBEAT, WORK
+    IS ASSIGNED BY CONSISTENT HASHING OVER THE LIVE MEMBERS, AND CLAIMED WITH
+    A LEASE SO NO TWO WORKERS PROCESS THE SAME KEY. LEASES OF DEAD WORKERS
+    EXPIRE, WHICH REMOVES THEM FROM THE RING AND FREES THEIR WORK.
+    """
+
+    def __init__(self, settings, please_stop):
+        """
+        :param settings: {"name", "duration", "heartbeat", "buckets", "leases": {"class", ...}}
+        :param please_stop: signal to stop the heartbeat; set if membership is lost
+        """
+        self.name = coalesce(settings.name, socket.gethostname() + "-" + str(os.getpid()))
+        self.duration = coalesce(settings.duration, LEASE_DURATION)
+        self.heartbeat = coalesce(settings.heartbeat, HEARTBEAT)
+        self.buckets = coalesce(settings.buckets, BUCKETS)
+        self.leases = new_leases(settings.leases)
+        self.locker = Lock("shard " + self.name)
+        self.held = set()
+        self.ring = HashRing([])
+
+        if not self.leases.acquire(MEMBER_PREFIX + self.name, self.name, self.duration):
+            Log.error("Shard {{name|quote}} is already a live member", name=self.name)
+        self._refresh_ring()
+        Log.note("Shard {{name|quote}} joined {{num}} members", name=self.name, num=len(self.ring.members))
+        Thread.run("heartbeat " + self.name, self._heartbeat, please_stop=please_stop)
+
+    def _heartbeat(self, please_stop):
+        member = MEMBER_PREFIX + self.name
+        last_renewal = time.time()
+        try:
+            while not please_stop:
+                (please_stop | Till(seconds=self.heartbeat)).wait()
+                if please_stop:
+                    break
+                try:
+                    if not self.leases.acquire(member, self.name, self.duration):
+                        Log.warning("Shard {{name|quote}} lost its membership, stopping", name=self.name)
+                        please_stop.go()
+                        break
+                    last_renewal = time.time()
+
+                    with self.locker:
+                        held = list(self.held)
+                    for k in held:
+                        if not self.leases.acquire(k, self.name, self.duration):
+                            Log.warning("Shard {{name|quote}} lost lease {{key|quote}}", name=self.name, key=k)
+                            with self.locker:
+                                self.held.discard(k)
+                    self._refresh_ring()
+                except Exception as e:
+                    Log.warning("Shard {{name|quote}} could not renew its leases", name=self.name, cause=e)
+                    if time.time() - last_renewal > self.duration - self.heartbeat:
+                        Log.warning("Shard {{name|quote}} membership is about to expire, stopping", name=self.name)
+                        please_stop.go()
+                        break
+        finally:
+            with self.locker:
+                keys = [member] + list(self.held)
+                self.held = set()
+            for k in keys:
+                try:
+                    self.leases.release(k, self.name)
+                except Exception as e:
+                    Log.warning("Shard {{name|quote}} could not release {{key|quote}}", name=self.name, key=k, cause=e)
+            Log.note("Shard {{name|quote}} left", name=self.name)
+
+    def _refresh_ring(self):
+        members = [k[len(MEMBER_PREFIX):] for k in self.leases.live(MEMBER_PREFIX)]
+        if set(members) != set(self.ring.members):
+            if DEBUG:
+                Log.note("Shard {{name|quote}} sees members {{members}}", name=self.name, members=members)
+            self.ring = HashRing(members)
+
+    def key(self, revision, file_name):
+        """
+        :return: THE UNIT OF WORK file_name BELONGS TO; DEPENDS ONLY ON ITS ARGUMENTS,
+                 SO EVERY WORKER AGREES
+        """
+        return revision + "|" + text_type(hash_key(file_name) % self.buckets)
+
+    def claim(self, key):
+        """
+        :return: True IF THIS SHARD OWNS key AND NOW HOLDS ITS LEASE
+        """
+        if self.ring.owner(key) != self.name:
+            return False
+        lease_key = WORK_PREFIX + key
+        # HELD BEFORE ASKING, SO release_revision() CLEANS UP IF acquire() FAILS PART WAY
+        with self.locker:
+            self.held.add(lease_key)
+        if not self.leases.acquire(lease_key, self.name, self.duration):
+            with self.locker:
+                self.held.discard(lease_key)
+            return False
+        return True
+
+    def release(self, key):
+        lease_key = WORK_PREFIX + key
+        with self.locker:
+            self.held.discard(lease_key)
+        self.leases.release(lease_key, self.name)
+
+    def release_revision(self, revision):
+        """
+        RELEASE EVERY WORK LEASE HELD FOR revision
+        """
+        prefix = WORK_PREFIX + revision + "|"
+        with self.locker:
+            keys = [k for k in self.held if k.startswith(prefix)]
+        for k in keys:
+            self.release(k[len(WORK_PREFIX):])
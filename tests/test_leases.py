@@ -0,0 +1,144 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from coco.leases import HashRing, SqliteLeases, FileLeases, new_leases
+
+MEMBER = "member|"
+WORK = "work|"
+KEYS = ["rev|" + str(i) for i in range(200)]
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertIsNone(HashRing([]).owner("anything"))
+
+    def test_distribution(self):
+        members = ["a", "b", "c", "d", "e"]
+        ring = HashRing(members)
+        keys = ["key" + str(i) for i in range(10000)]
+        counts = {m: 0 for m in members}
+        for k in keys:
+            counts[ring.owner(k)] += 1
+        for m, c in counts.items():
+            self.assertGreater(c, len(keys) * 0.10, m)
+            self.assertLess(c, len(keys) * 0.30, m)
+
+    def test_join_moves_few_keys(self):
+        keys = ["key" + str(i) for i in range(10000)]
+        before = HashRing(["a", "b", "c", "d", "e"])
+        after = HashRing(["a", "b", "c", "d", "e", "f"])
+        moved = [k for k in keys if before.owner(k) != after.owner(k)]
+        # ONLY KEYS TAKEN BY THE NEW MEMBER MOVE, ABOUT 1/6 OF THEM
+        self.assertTrue(all(after.owner(k) == "f" for k in moved))
+        self.assertLess(len(moved), len(keys) * 0.30)
+
+    def test_leave_moves_few_keys(self):
+        keys = ["key" + str(i) for i in range(10000)]
+        before = HashRing(["a", "b", "c", "d", "e"])
+        after = HashRing(["a", "b", "c", "e"])
+        moved = [k for k in keys if before.owner(k) != after.owner(k)]
+        # ONLY THE KEYS OF THE MEMBER THAT LEFT MOVE
+        self.assertTrue(all(before.owner(k) == "d" for k in moved))
+        self.assertEqual(len(moved), sum(1 for k in keys if before.owner(k) == "d"))
+
+    def test_stable_across_instances(self):
+        self.assertEqual(
+            [HashRing(["b", "a", "c"]).owner(k) for k in KEYS],
+            [HashRing(["c", "b", "a"]).owner(k) for k in KEYS]
+        )
+
+
+class LeasesTests(object):
+    """
+    SAME TESTS FOR EVERY BACKEND
+    """
+
+    def settings(self):
+        raise NotImplementedError
+
+    def new_leases(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.leases = self.new_leases()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_acquire(self):
+        self.assertTrue(self.leases.acquire("k", "a", 60))
+        self.assertFalse(self.leases.acquire("k", "b", 60))
+
+    def test_renew(self):
+        self.assertTrue(self.leases.acquire("k", "a", 0.5))
+        time.sleep(0.3)
+        self.assertTrue(self.leases.acquire("k", "a", 0.5))
+        time.sleep(0.3)
+        # STILL HELD, BECAUSE OF THE RENEWAL
+        self.assertFalse(self.leases.acquire("k", "b", 60))
+
+    def test_expiry_takeover(self):
+        self.assertTrue(self.leases.acquire("k", "a", 0.2))
+        time.sleep(0.3)
+        self.assertTrue(self.leases.acquire("k", "b", 60))
+        self.assertFalse(self.leases.acquire("k", "a", 60))
+
+    def test_release(self):
+        self.assertTrue(self.leases.acquire("k", "a", 60))
+        self.leases.release("k", "b")  # NOT THE OWNER, NO EFFECT
+        self.assertFalse(self.leases.acquire("k", "b", 60))
+        self.leases.release("k", "a")
+        self.assertTrue(self.leases.acquire("k", "b", 60))
+
+    def test_new_leases(self):
+        leases = new_leases(self.settings())
+        self.assertTrue(leases.acquire("k", "a", 60))
+        self.assertFalse(self.leases.acquire("k", "b", 60))
+
+    def test_live(self):
+        self.leases.acquire(MEMBER + "a", "a", 60)
+        self.leases.acquire(MEMBER + "b", "b", 0.2)
+        self.leases.acquire(WORK + "x", "a", 60)
+        self.assertEqual(sorted(self.leases.live(MEMBER)), [MEMBER + "a", MEMBER + "b"])
+        time.sleep(0.3)
+        self.assertEqual(self.leases.live(MEMBER), [MEMBER + "a"])
+        self.assertEqual(self.leases.live(WORK), [WORK + "x"])
+
+
+class TestSqliteLeases(LeasesTests, unittest.TestCase):
+
+    def settings(self):
+        return {"class": "coco.leases.SqliteLeases", "filename": os.path.join(self.temp, "leases.sqlite")}
+
+    def new_leases(self):
+        return SqliteLeases(os.path.join(self.temp, "leases.sqlite"))
+
+
+class TestFileLeases(LeasesTests, unittest.TestCase):
+
+    def settings(self):
+        return {"class": "coco.leases.FileLeases", "directory": os.path.join(self.temp, "leases")}
+
+    def new_leases(self):
+        return FileLeases(os.path.join(self.temp, "leases"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,312 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from future.utils import text_type
+from mo_dots import wrap, unwrap
+from mo_threads import Signal
+from mo_times.dates import Date
+from mo_times.durations import Duration
+
+from coco import post_etl
+from coco.post_etl import _fingerprint, process_batch, _read_watermark, _write_watermark, _since, _poll, daemon
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_record_and_aggregate_paths_agree(self):
+        # WHAT process_batch SEES: THE RAW RECORDS, LINES AS INTEGERS
+        from_records = _fingerprint(2, {1, 2, 12}, {3, 4})
+
+        # WHAT _reuse_summaries SEES: ES UNION AGGREGATES, LINES AS STRINGS, IN ANY ORDER
+        from_aggregate = _fingerprint(2.0, ["12", "1", "2"], ["4", "3", "2"])
+
+        self.assertEqual(from_records, from_aggregate)
+
+    def test_moved_lines_are_detected(self):
+        self.assertNotEqual(_fingerprint(2, [1, 2], [3]), _fingerprint(2, [2, 3], [4]))
+
+    def test_count_is_detected(self):
+        self.assertNotEqual(_fingerprint(2, [1, 2], [3]), _fingerprint(3, [1, 2], [3]))
+
+
+class TestReuse(unittest.TestCase):
+
+    def setUp(self):
+        self.http = post_etl.http
+        self.settings = wrap({"url": "http://localhost/query"})
+
+    def tearDown(self):
+        post_etl.http = self.http
+
+    def summarize(self, revision, previous_revision, coverage, previous_index, index):
+        """
+        RUN process_batch ON ALL FILES OF coverage
+        :return: THE FAKE ActiveData, FOR INSPECTING THE QUERIES
+        """
+        fake = FakeActiveData(revision, coverage, previous_index, index)
+        post_etl.http = fake
+        todo = wrap([
+            {"source": {"file": {"name": name}}, "count": len(records)}
+            for name, records in sorted(_by_file(coverage).items())
+        ])
+        process_batch([todo], revision, previous_revision, None, index, self.settings, Signal())
+        return fake
+
+    def test_unchanged_file_is_reused(self):
+        before = [_record("prev", "a.js", [1, 2], [3]), _record("prev", "b.js", [5], [6])]
+        after = [_record("curr", "a.js", [1, 2], [3]), _record("curr", "b.js", [5, 6], [])]
+        previous_index = FakeIndex()
+        self.summarize("prev", None, before, FakeIndex(), previous_index)
+
+        index = FakeIndex()
+        fake = self.summarize("curr", "prev", after, previous_index, index)
+
+        a = index.docs["curr|a.js"]
+        self.assertEqual(a.etl.reused_from, "prev")
+        self.assertEqual(a.etl.num_source_records, 1)
+        self.assertEqual(a.build.revision12, "curr")
+        self.assertEqual(list(a.source.file.covered), [1, 2])
+
+        b = index.docs["curr|b.js"]
+        self.assertIsNone(b.etl.reused_from)
+        self.assertEqual(list(b.source.file.covered), [5, 6])
+
+        # ONLY THE CHANGED FILE IS PULLED AS RAW RECORDS
+        self.assertEqual(fake.raw_files, [["b.js"]])
+
+    def test_moved_lines_are_not_reused(self):
+        # SAME COUNTS AND TOTALS, BUT A LINE WAS ADDED ABOVE THE CODE
+        before = [_record("prev", "a.js", [1, 2], [3])]
+        after = [_record("curr", "a.js", [2, 3], [4])]
+        previous_index = FakeIndex()
+        self.summarize("prev", None, before, FakeIndex(), previous_index)
+
+        index = FakeIndex()
+        self.summarize("curr", "prev", after, previous_index, index)
+
+        a = index.docs["curr|a.js"]
+        self.assertIsNone(a.etl.reused_from)
+        self.assertEqual(list(a.source.file.covered), [2, 3])
+        self.assertEqual(list(a.source.file.uncovered), [4])
+
+    def test_no_previous_fingerprint(self):
+        before = [_record("prev", "a.js", [1, 2], [3])]
+        after = [_record("curr", "a.js", [1, 2], [3])]
+        previous_index = FakeIndex()
+        self.summarize("prev", None, before, FakeIndex(), previous_index)
+        for d in previous_index.docs.values():
+            d.etl.fingerprint = None  # SUMMARIZED BEFORE FINGERPRINTS EXISTED
+
+        index = FakeIndex()
+        fake = self.summarize("curr", "prev", after, previous_index, index)
+
+        self.assertIsNone(index.docs["curr|a.js"].etl.reused_from)
+        self.assertEqual(fake.union_queries, 0, "expecting no fingerprint query when there is nothing to compare to")
+
+    def test_summarized_files_are_skipped(self):
+        coverage = [_record("curr", "a.js", [1], [2])]
+        index = FakeIndex()
+        self.summarize("curr", None, coverage, FakeIndex(), index)
+        fake = self.summarize("curr", None, coverage, FakeIndex(), index)
+        self.assertEqual(fake.raw_files, [])
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp, "watermark.json")
+        self.http = post_etl.http
+        self.process_revision = post_etl.process_revision
+        self._poll = post_etl._poll
+        self.processed = []
+        self.please_stop = Signal()
+        self.settings = wrap({
+            "url": "http://localhost/query",
+            "daemon": {"watermark": self.filename, "interval": "second", "start": "2018-01-01"}
+        })
+
+    def tearDown(self):
+        post_etl.http = self.http
+        post_etl.process_revision = self.process_revision
+        post_etl._poll = self._poll
+        shutil.rmtree(self.temp)
+
+    def fake(self, revisions, summarized, stop_at=None):
+        """
+        :param revisions: list of (revision, push date, number of coverage records)
+        :param summarized: map from revision to number of records already summarized
+        :param stop_at: revision that is interrupted by please_stop
+        """
+        def post_json(url, json):
+            if json["from"] == "coverage":
+                data = [
+                    {"build": {"revision12": r}, "repo": {"push": {"date": d}, "branch": {"name": "central"}}, "count": c}
+                    for r, d, c in revisions
+                ]
+            else:
+                data = [{"build": {"revision12": r}, "count": c} for r, c in summarized.items()]
+            return wrap({"data": data})
+
+        def process_revision(rev, previous_rev, coverage_index, coverage_summary_index, shard, settings, please_stop):
+            self.processed.append(rev)
+            if rev == stop_at:
+                please_stop.go()
+
+        post_etl.http = FakeHttp(post_json)
+        post_etl.process_revision = process_revision
+
+    def test_watermark_round_trip(self):
+        self.assertIsNone(_read_watermark(self.filename))
+        _write_watermark(self.filename, {"date": 1000, "revision": "aaa"})
+        _write_watermark(self.filename, {"date": 2000, "revision": "bbb"})
+        watermark = _read_watermark(self.filename)
+        self.assertEqual(watermark.date, 2000)
+        self.assertEqual(watermark.revision, "bbb")
+        self.assertEqual(os.listdir(self.temp), ["watermark.json"], "expecting no temp files left behind")
+
+    def test_since(self):
+        watermark = wrap({"date": Date("2018-01-10").unix, "revision": "aaa"})
+        self.assertEqual(_since(watermark, Duration("day"), None).unix, Date("2018-01-09").unix)
+        self.assertEqual(_since(None, Duration("day"), "2018-01-01").unix, Date("2018-01-01").unix)
+
+    def test_summarized_revisions_are_skipped(self):
+        self.fake([("aaa", 1000, 5), ("bbb", 2000, 3)], {"aaa": 5, "bbb": 1})
+        watermark = _poll(Date(0), None, self.filename, None, None, self.settings, self.please_stop)
+
+        self.assertEqual(self.processed, ["bbb"])
+        self.assertEqual(watermark.revision, "bbb")
+        self.assertEqual(_read_watermark(self.filename).revision, "bbb")
+
+    def test_interrupted_revision_is_not_marked(self):
+        self.fake([("aaa", 1000, 5), ("bbb", 2000, 3), ("ccc", 3000, 3)], {}, stop_at="bbb")
+        watermark = _poll(Date(0), None, self.filename, None, None, self.settings, self.please_stop)
+
+        self.assertEqual(self.processed, ["aaa", "bbb"])
+        self.assertEqual(watermark.revision, "aaa")
+        self.assertEqual(_read_watermark(self.filename).revision, "aaa")
+
+    def test_corrupt_watermark_starts_from_start(self):
+        with open(self.filename, "wb") as f:
+            f.write(b'{"date": 10')  # PARTIAL FILE
+        seen = []
+
+        def poll(since, watermark, *args):
+            seen.append((since, watermark))
+            self.please_stop.go()
+            return watermark
+
+        post_etl._poll = poll
+        daemon(None, None, self.settings, self.please_stop)
+
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0][0].unix, Date("2018-01-01").unix)
+        self.assertIsNone(seen[0][1])
+        self.assertTrue(self.please_stop)
+
+
+def _record(revision, name, covered, uncovered):
+    return {
+        "source": {"language": "js", "file": {
+            "name": name,
+            "covered": covered,
+            "uncovered": uncovered,
+            "total_covered": len(covered),
+            "total_uncovered": len(uncovered)
+        }},
+        "build": {"revision12": revision},
+        "repo": {"branch": {"name": "central"}}
+    }
+
+
+def _by_file(coverage):
+    output = {}
+    for r in coverage:
+        output.setdefault(r["source"]["file"]["name"], []).append(r)
+    return output
+
+
+class FakeHttp(object):
+
+    def __init__(self, post_json):
+        self.post_json = post_json
+
+
+class FakeIndex(object):
+
+    def __init__(self):
+        self.docs = {}
+
+    def extend(self, records):
+        for r in records:
+            self.docs[r["id"]] = wrap(unwrap(r["value"]))
+
+
+class FakeActiveData(object):
+    """
+    ANSWER THE FEW QUERY SHAPES post_etl SENDS, FOR ONE REVISION
+    """
+
+    def __init__(self, revision, coverage, previous_index, index):
+        self.revision = revision
+        self.coverage = _by_file(coverage)
+        self.previous_index = previous_index
+        self.index = index
+        self.raw_files = []
+        self.union_queries = 0
+
+    def post_json(self, url, json):
+        return wrap({"data": self.answer(json)})
+
+    def answer(self, query):
+        files = [f for t in query["where"]["and"] if "in" in t for f in t["in"]["source.file.name"]]
+
+        if query["from"] == "coverage-summary":
+            if query.get("edges"):
+                # WHAT HAVE WE SUMMARIZED ALREADY?
+                return [
+                    {"source": {"file": {"name": d.source.file.name}}, "count": d.etl.num_source_records}
+                    for d in self.index.docs.values()
+                    if d.source.file.name in files
+                ]
+            previous = [d for d in self.previous_index.docs.values() if d.source.file.name in files]
+            if query["select"] == "source":
+                return [unwrap(d.source) for d in previous]
+            return [
+                {"name": d.source.file.name, "fingerprint": d.etl.fingerprint}
+                for d in previous
+                if d.etl.fingerprint
+            ]
+
+        if query.get("limit") == 1:
+            return [self.coverage[files[0]][0]]
+        if query["select"] == "source.file":
+            self.raw_files.append(sorted(files))
+            return [r["source"]["file"] for f in files for r in self.coverage.get(f, [])]
+
+        # UNION AGGREGATE, WITH LINES AS STRINGS, LIKE THE SCHEMA MAPS THEM
+        self.union_queries += 1
+        output = []
+        for f in files:
+            records = self.coverage.get(f, [])
+            output.append({
+                "source": {"file": {"name": f}},
+                "count": len(records),
+                "covered": sorted(set(text_type(c) for r in records for c in r["source"]["file"]["covered"])),
+                "uncovered": sorted(set(text_type(u) for r in records for u in r["source"]["file"]["uncovered"]))
+            })
+        return output
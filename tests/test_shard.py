@@ -0,0 +1,221 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from future.utils import text_type
+from mo_dots import wrap
+from mo_threads import Signal, Till
+
+from coco.leases import SqliteLeases, hash_key
+from coco.shard import Shard, MEMBER_PREFIX, WORK_PREFIX
+
+REVISION = "rev"
+FILES = ["dom/file" + str(i) + ".js" for i in range(1000)]
+BUCKETS = 64
+
+
+class FailingLeases(SqliteLeases):
+    """
+    SqliteLeases THAT RAISES WHILE failing IS SET, TO SIMULATE "database is locked"
+    """
+    failing = False
+
+    def acquire(self, key, owner, duration):
+        if FailingLeases.failing:
+            raise Exception("database is locked")
+        return SqliteLeases.acquire(self, key, owner, duration)
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp, "leases.sqlite")
+        self.please_stop = Signal()
+        FailingLeases.failing = False
+
+    def tearDown(self):
+        self.please_stop.go()
+        FailingLeases.failing = False
+        time.sleep(0.3)  # LET THE HEARTBEAT RELEASE
+        shutil.rmtree(self.temp)
+
+    def new_shard(self, name, duration=60, leases_class="coco.leases.SqliteLeases"):
+        return Shard(wrap({
+            "name": name,
+            "duration": duration,
+            "heartbeat": 0.1,
+            "buckets": BUCKETS,
+            "leases": {"class": leases_class, "filename": self.filename}
+        }), self.please_stop)
+
+    def wait_for_stop(self, timeout=5):
+        (self.please_stop | Till(seconds=timeout)).wait()
+        return bool(self.please_stop)
+
+    def test_key_is_deterministic(self):
+        a = self.new_shard("a")
+        b = self.new_shard("b")
+        keys = set(a.key(REVISION, f) for f in FILES)
+        self.assertEqual(keys, set(b.key(REVISION, f) for f in FILES))
+        self.assertEqual(len(keys), BUCKETS)
+        self.assertTrue(all(k.startswith(REVISION + "|") for k in keys))
+
+    def test_claim_and_release_revision(self):
+        shard = self.new_shard("a")
+        keys = sorted(set(shard.key(REVISION, f) for f in FILES))
+        self.assertTrue(all(shard.claim(k) for k in keys))
+
+        other = SqliteLeases(self.filename)
+        self.assertEqual(len(other.live(WORK_PREFIX)), BUCKETS)
+        self.assertFalse(other.acquire(WORK_PREFIX + keys[0], "b", 60))
+
+        shard.release_revision(REVISION)
+        self.assertEqual(shard.held, set())
+        self.assertEqual(other.live(WORK_PREFIX), [])
+
+    def test_failed_claim_is_released(self):
+        shard = self.new_shard("a", leases_class="tests.test_shard.FailingLeases")
+        key = shard.key(REVISION, FILES[0])
+        FailingLeases.failing = True
+        self.assertRaises(Exception, shard.claim, key)
+        FailingLeases.failing = False
+        self.assertEqual(shard.held, {WORK_PREFIX + key})
+
+        shard.release_revision(REVISION)
+        self.assertEqual(shard.held, set())
+
+    def test_ring_sees_new_members(self):
+        a = self.new_shard("a")
+        self.new_shard("b")
+        time.sleep(0.5)
+        self.assertEqual(a.ring.members, ["a", "b"])
+
+    def test_lost_membership_stops(self):
+        shard = self.new_shard("a")
+        key = shard.key(REVISION, FILES[0])
+        self.assertTrue(shard.claim(key))
+
+        # SOMEONE ELSE TAKES THE MEMBERSHIP
+        thief = SqliteLeases(self.filename)
+        thief.release(MEMBER_PREFIX + "a", "a")
+        self.assertTrue(thief.acquire(MEMBER_PREFIX + "a", "thief", 60))
+
+        self.assertTrue(self.wait_for_stop(), "expecting the shard to signal stop")
+        time.sleep(0.3)
+        self.assertEqual(thief.live(WORK_PREFIX), [])
+
+    def test_store_errors_are_survived(self):
+        self.new_shard("a", leases_class="tests.test_shard.FailingLeases")
+        FailingLeases.failing = True
+        time.sleep(0.5)
+        FailingLeases.failing = False
+        self.assertFalse(self.wait_for_stop(timeout=0.5), "expecting the heartbeat to keep running")
+
+    def test_expiring_membership_stops(self):
+        self.new_shard("a", duration=0.5, leases_class="tests.test_shard.FailingLeases")
+        FailingLeases.failing = True
+        self.assertTrue(self.wait_for_stop(), "expecting the shard to stop before its membership expires")
+
+
+class TestShardProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.leases = {"class": "coco.leases.SqliteLeases", "filename": os.path.join(self.temp, "leases.sqlite")}
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_buckets_are_split(self):
+        names = ["w" + str(i) for i in range(4)]
+        results = _run_workers(self.leases, names, len(names), 60)
+        claimed = [k for r in results for k in r]
+        self.assertEqual(len(results), len(names))
+        self.assertEqual(sorted(claimed), _all_keys())
+        self.assertTrue(all(results), "expecting every worker to get some buckets")
+
+    def test_dead_worker_is_taken_over(self):
+        # A WORKER JOINS, CLAIMS ITS BUCKETS, AND DIES WITHOUT RELEASING
+        first = _run_workers(self.leases, ["dead", "w0", "w1"], 3, 1)
+        self.assertTrue(first[0], "expecting the dead worker to hold some buckets")
+        time.sleep(1.5)
+
+        # ITS LEASES EXPIRE, SO THE SURVIVORS TAKE ALL THE BUCKETS
+        results = _run_workers(self.leases, ["w0", "w1"], 2, 60)
+        claimed = [k for r in results for k in r]
+        self.assertEqual(sorted(claimed), _all_keys())
+
+
+def _all_keys():
+    return sorted(set(REVISION + "|" + text_type(hash_key(f) % BUCKETS) for f in FILES))
+
+
+def _run_workers(leases, names, num_members, duration):
+    """
+    RUN A Shard IN ONE PROCESS PER NAME
+    :return: LIST OF CLAIMED BUCKETS, PER WORKER
+    """
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_worker, args=(leases, name, num_members, duration, queue))
+        for name in names
+    ]
+    for p in processes:
+        p.start()
+    results = dict(queue.get(timeout=30) for _ in processes)
+    for p in processes:
+        p.join(timeout=30)
+    return [results[n] for n in names if results.get(n) is not None]
+
+
+def _worker(leases, name, num_members, duration, queue):
+    please_stop = Signal()
+    shard = Shard(wrap({
+        "name": name,
+        "duration": duration,
+        "heartbeat": 0.1,
+        "buckets": BUCKETS,
+        "leases": leases
+    }), please_stop)
+
+    timeout = time.time() + 20
+    while len(shard.ring.members) != num_members:
+        if time.time() > timeout:
+            queue.put((name, None))
+            please_stop.go()
+            return
+        time.sleep(0.05)
+
+    keys = sorted(set(shard.key(REVISION, f) for f in FILES))
+    claimed = [k for k in keys if shard.claim(k)]
+    queue.put((name, claimed))
+    if name == "dead":
+        queue.close()
+        queue.join_thread()  # os._exit() DOES NOT FLUSH THE QUEUE
+        os._exit(0)  # NO CLEANUP, LIKE A CRASH
+
+    # STAY A MEMBER UNTIL EVERYONE HAS CLAIMED
+    time.sleep(0.5)
+    shard.release_revision(REVISION)
+    please_stop.go()
+    time.sleep(0.3)  # LET THE HEARTBEAT RELEASE THE MEMBERSHIP
+
+
+if __name__ == "__main__":
+    unittest.main()